@@ -7,6 +7,7 @@ import fabio.tifimage as tif
 
 import numpy as np
 import imageio
+import tifffile
 
 from popcorn.resampling import bin_resize
 
@@ -21,7 +22,8 @@ def create_directory(path):
         None
     """
     if not os.path.exists(path):
-        os.makedirs(path)
+        # exist_ok: parallel workers may create the same directory at the same time
+        os.makedirs(path, exist_ok=True)
 
 
 def create_list_of_files(folder_name, extension):
@@ -75,6 +77,26 @@ def open_image(filename):
         return im
 
 
+def open_memory_mapped_image(filename):
+    """opens a 2D image as a read-only memory map (uncompressed .tif), other images are fully opened
+
+    Args:
+        filename (str): file name
+
+    Returns:
+        (numpy.ndarray): 2D image (numpy.memmap when the image data can be mapped)
+    """
+    filename = str(filename)
+    # The extension is checked (not the whole path, which may contain "tif" in a folder name)
+    if os.path.splitext(filename)[1].lower() in ('.tif', '.tiff'):
+        try:
+            return tifffile.memmap(filename, mode='r')
+        # Compressed/tiled image data cannot be mapped (TiffFileError is not a ValueError in older tifffile versions)
+        except (ValueError, tifffile.TiffFileError):
+            pass
+    return open_image(filename)
+
+
 def open_sequence(filenames_or_input_folder):
     """opens a sequence of images
 
@@ -124,7 +146,7 @@ def open_cropped_image(filename, min_max_y_x_list):
         (numpy.ndarray): cropped image
     """
 
-    ref_image = open_image(filename)
+    ref_image = open_memory_mapped_image(filename)
     # In case of negative coordinates, we get the reverse position (max - val)
     for coors_nb, coordinates in enumerate(min_max_y_x_list):
         for coor_nb, coordinate in enumerate(coordinates):
@@ -134,6 +156,9 @@ def open_cropped_image(filename, min_max_y_x_list):
     image = ref_image[min_max_y_x_list[0][0]: min_max_y_x_list[0][1] + 1,
                       min_max_y_x_list[1][0]: min_max_y_x_list[1][1] + 1]
 
+    # Only the cropped part of a memory-mapped image is read
+    if isinstance(image, np.memmap):
+        image = np.array(image)
     return image
 
 
@@ -262,29 +287,33 @@ def save_tif_image(image, filename, bit=32, rgb=False, header=None):
         imageio.imwrite(filename + '.tif', image)
     elif header:
         if bit == 32:
-            tif.TifImage(data=image.astype(np.float32), header=header).write(filename + '.tif')
+            tif.TifImage(data=image.astype(np.float32, copy=False), header=header).write(filename + '.tif')
         else:
-            tif.TifImage(data=image.astype(np.uint16), header=header).write(filename + '.tif')
+            tif.TifImage(data=image.astype(np.uint16, copy=False), header=header).write(filename + '.tif')
     elif bit == 32:
-        tif.TifImage(data=image.astype(np.float32)).write(filename + '.tif')
+        tif.TifImage(data=image.astype(np.float32, copy=False)).write(filename + '.tif')
     else:
-        tif.TifImage(data=image.astype(np.uint16)).write(filename + '.tif')
+        tif.TifImage(data=image.astype(np.uint16, copy=False)).write(filename + '.tif')
 
 
-def save_tif_sequence(image, path, bit=32, header=None):
+def save_tif_sequence(image, path, bit=32, header=None, filenames=None):
     """saves a sequence of images to .tif format (either int16 or float32)
 
     Args:
         image (numpy.ndarray): 2D image
-        path (str):            complete path + regular expression of file names
+        path (str):            complete path + regular expression of file names (output folder if filenames is given)
         bit (int):             16: int16, 32: float32
         header (str):          header
+        filenames (list[str]): file names of the slices (extensions are replaced by .tif), None: path + slice index
 
     Returns:
         None
     """
     for i in range(image.shape[0]):
-        image_path = path + '{:04d}'.format(i)
+        if filenames is None:
+            image_path = path + '{:04d}'.format(i)
+        else:
+            image_path = os.path.join(path, os.path.splitext(os.path.basename(filenames[i]))[0])
         save_tif_image(image[i, :, :], image_path, bit, header=header)
 
 
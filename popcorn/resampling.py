@@ -1,21 +1,114 @@
+from functools import lru_cache
+
 import numpy as np
+from numba import jit, prange
 
 from skimage.transform import resize
 import SimpleITK as Sitk
 
-def conversion_from_uint16_to_float32(image, min_value, max_value):
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+@jit(nopython=True, parallel=True, fastmath=True, cache=True)
+def _u16_to_f32(image, scale, offset, output_image):
+    """fused cast + scale + offset kernel (one read of image, one write of output_image)
+
+    Args:
+        image (numpy.ndarray):        flat input image
+        scale (float):                multiplicative factor
+        offset (float):               additive offset
+        output_image (numpy.ndarray): flat float32 output buffer
+
+    Returns:
+        None
+    """
+    for i in prange(image.size):
+        output_image[i] = image[i] * scale + offset
+
+
+@lru_cache(maxsize=16)
+def _build_u16_lut(min_value, max_value):
+    """builds (and caches) the 65536 entries uint16 -> float32 look-up table for given min max parameters
+
+    Args:
+        min_value (float): min float value
+        max_value (float): max float value
+
+    Returns:
+        (numpy.ndarray): read-only float32 look-up table
+    """
+    lut = np.empty(65536, dtype=np.float32)
+    _u16_to_f32(np.arange(65536, dtype=np.uint16), np.float32((max_value - min_value) / 65535),
+                np.float32(min_value), lut)
+    lut.flags.writeable = False
+    return lut
+
+
+def _check_output_buffer(out, shape, dtypes):
+    """checks that a caller-supplied output buffer can be written by the numba kernels (they don't check bounds)
+
+    Args:
+        out (numpy.ndarray):        output buffer
+        shape (tuple[int]):         expected shape (input image shape)
+        dtypes (list[numpy.dtype]): accepted output types
+
+    Returns:
+        None
+    """
+    if out.shape != tuple(shape):
+        raise Exception('Error: out buffer shape ' + str(out.shape) + ' does not match image shape '
+                        + str(tuple(shape)))
+    if out.dtype not in dtypes:
+        raise Exception('Error: out buffer type ' + str(out.dtype) + ' is not supported (expected one of '
+                        + ', '.join(str(np.dtype(dtype)) for dtype in dtypes) + ')')
+    if not out.flags.c_contiguous or not out.flags.writeable:
+        raise Exception('Error: out buffer must be a writeable C-contiguous array')
+
+
+def conversion_from_uint16_to_float32(image, min_value, max_value, out=None):
     """Converts 16 bit uint into 32 bit float using min max parameters (0 -> min, 65535 -> max)
 
     Args:
         image (numpy.ndarray): input 16bit image
         min_value (float):     min float value
         max_value (float):     max float value
+        out (numpy.ndarray):   optional contiguous float32 output buffer of image shape, reused across calls (e.g. when
+                               converting a sequence slice by slice)
 
     Returns:
         (numpy.ndarray): converted image (float32)
     """
-    image = image.astype(np.float32)
-    return (image/65535) * (max_value - min_value) - min_value
+    if out is not None:
+        _check_output_buffer(out, np.shape(image), (np.float32,))
+    # uint16 input only has 65536 possible values: a single gather in a look-up table is enough
+    if image.dtype == np.uint16:
+        return np.take(_build_u16_lut(float(min_value), float(max_value)), image, out=out)
+
+    image = _kernel_input(image)
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    _u16_to_f32(image.ravel(), np.float32((max_value - min_value) / 65535), np.float32(min_value), out.ravel())
+    return out
+
+
+@jit(nopython=True, parallel=True, fastmath=True, cache=True)
+def _f32_to_u16(image, min_value, scale, output_image):
+    """fused offset + scale + rounding + saturation kernel (one read of image, one write of output_image)
+
+    Args:
+        image (numpy.ndarray):        flat input image
+        min_value (float):            value mapped to 0
+        scale (float):                65535 / (max value - min value)
+        output_image (numpy.ndarray): flat uint16 output buffer
+
+    Returns:
+        None
+    """
+    for i in prange(image.size):
+        output_image[i] = np.uint16(min(max((image[i] - min_value) * scale + 0.5, 0.), 65535.))
 
 
 def conversion_from_float32_to_uint16(image, min_value, max_value):
@@ -23,55 +116,357 @@ def conversion_from_float32_to_uint16(image, min_value, max_value):
 
     Args:
         image (numpy.ndarray): input 32bit image
-        min_value (float):     min float value
-        max_value (float):     max float value
+        min_value (float):     min float value (any value below will be set to 0)
+        max_value (float):     max float value (any value above will be set to 65535)
+
+    Returns:
+        (numpy.ndarray): converted image (uint16)
+    """
+    image = _kernel_input(image)
+    output_image = np.empty(image.shape, dtype=np.uint16)
+    _f32_to_u16(image.ravel(), np.float32(min_value), np.float32(65535 / (max_value - min_value)),
+                output_image.ravel())
+    return output_image
+
+
+@lru_cache(maxsize=16)
+def _fused_u16_u16_lut(input_min_value, input_max_value, output_min_value, output_max_value):
+    """builds (and caches) the 65536 entries uint16 -> uint16 look-up table composing
+    conversion_from_uint16_to_float32 (input range) and conversion_from_float32_to_uint16 (output range)
+
+    Args:
+        input_min_value (float):  float value of input 0
+        input_max_value (float):  float value of input 65535
+        output_min_value (float): float value of output 0
+        output_max_value (float): float value of output 65535
+
+    Returns:
+        (numpy.ndarray): read-only uint16 look-up table
+    """
+    lut = np.empty(65536, dtype=np.uint16)
+    _f32_to_u16(_build_u16_lut(input_min_value, input_max_value), np.float32(output_min_value),
+                np.float32(65535 / (output_max_value - output_min_value)), lut)
+    lut.flags.writeable = False
+    return lut
+
+
+def conversion_from_uint16_to_uint16(image, input_min_value, input_max_value, output_min_value, output_max_value):
+    """Converts 16 bit uint coded on [input_min_value;input_max_value] into 16 bit uint coded on
+    [output_min_value;output_max_value], same result as conversion_from_uint16_to_float32 followed by
+    conversion_from_float32_to_uint16 but with a single look-up per voxel (no float32 intermediate image)
+
+    Args:
+        image (numpy.ndarray):    input 16bit image
+        input_min_value (float):  float value of input 0
+        input_max_value (float):  float value of input 65535
+        output_min_value (float): float value of output 0 (any value below will be set to 0)
+        output_max_value (float): float value of output 65535 (any value above will be set to 65535)
 
     Returns:
         (numpy.ndarray): converted image (uint16)
     """
-    image = (image - min_value) / (max_value - min_value) * 65535
-    return image.astype(np.uint16)
+    if (input_min_value, input_max_value) == (output_min_value, output_max_value):
+        return image
+    return np.take(_fused_u16_u16_lut(float(input_min_value), float(input_max_value), float(output_min_value),
+                                      float(output_max_value)), image)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _min_max(image):
+    """computes both min and max of an image in a single (chunked, parallel) pass
+
+    Args:
+        image (numpy.ndarray): flat input image
+
+    Returns:
+        (float, float): min and max values
+    """
+    nb_chunks = min(64, image.size)
+    chunk_size = (image.size + nb_chunks - 1) // nb_chunks
+    chunk_mins = np.empty(nb_chunks, dtype=image.dtype)
+    chunk_maxs = np.empty(nb_chunks, dtype=image.dtype)
+    for chunk_nb in prange(nb_chunks):
+        start = chunk_nb * chunk_size
+        stop = min(start + chunk_size, image.size)
+        current_min = image[min(start, image.size - 1)]
+        current_max = current_min
+        for i in range(start, stop):
+            if image[i] < current_min:
+                current_min = image[i]
+            elif image[i] > current_max:
+                current_max = image[i]
+        chunk_mins[chunk_nb] = current_min
+        chunk_maxs[chunk_nb] = current_max
+    return chunk_mins.min(), chunk_maxs.max()
+
+
+@jit(nopython=True, parallel=True, fastmath=True, cache=True)
+def _normalize(image, min_value, inverse_range, output_image):
+    """fused cast + normalization + [0;1] clipping kernel (one read of image, one write of output_image)
+
+    Args:
+        image (numpy.ndarray):        flat input image
+        min_value (float):            value mapped to 0
+        inverse_range (float):        1 / (max value - min value)
+        output_image (numpy.ndarray): flat float32 output buffer (may be image itself)
+
+    Returns:
+        None
+    """
+    for i in prange(image.size):
+        output_image[i] = min(max((image[i] - min_value) * inverse_range, 0.), 1.)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _histogram_u16(image):
+    """computes the 65536 bins histogram of a uint16 image (one partial histogram per chunk, then summed)
+
+    Args:
+        image (numpy.ndarray): flat uint16 image
+
+    Returns:
+        (numpy.ndarray): histogram (int64)
+    """
+    nb_chunks = min(16, image.size)
+    chunk_size = (image.size + nb_chunks - 1) // nb_chunks
+    partial_histograms = np.zeros((nb_chunks, 65536), dtype=np.int64)
+    for chunk_nb in prange(nb_chunks):
+        for i in range(chunk_nb * chunk_size, min((chunk_nb + 1) * chunk_size, image.size)):
+            partial_histograms[chunk_nb, image[i]] += 1
+    return partial_histograms.sum(axis=0)
+
+
+def _percentiles_u16(image, p_low, p_high):
+    """computes two percentiles of a uint16 image from its histogram (single pass, no sort)
+
+    Args:
+        image (numpy.ndarray): input uint16 image
+        p_low (float):         low percentile (in [0;100])
+        p_high (float):        high percentile (in [0;100])
+
+    Returns:
+        (int, int): low and high percentile values
+    """
+    cumulative_histogram = np.cumsum(_histogram_u16(image.ravel()))
+    ranks = np.array([p_low, p_high]) / 100 * (image.size - 1)
+    low_value, high_value = np.searchsorted(cumulative_histogram, ranks, side='right')
+    return int(low_value), int(high_value)
 
 
-def normalize_image(image):
+def _normalize_into(image, min_image, max_image, out):
+    """normalizes a contiguous image into a contiguous output buffer (float32 written directly, other float types
+    written block by block through a small float32 scratch buffer so that the full volume is never stored in float32)
+
+    Args:
+        image (numpy.ndarray): contiguous input image
+        min_image (float):     value mapped to 0
+        max_image (float):     value mapped to 1
+        out (numpy.ndarray):   contiguous output buffer of image shape
+
+    Returns:
+        (numpy.ndarray): out
+    """
+    _check_output_buffer(out, image.shape, (np.float16, np.float32, np.float64))
+    value_range = float(max_image) - float(min_image)
+    # A flat image (max == min) is normalized to 0 instead of dividing by 0
+    inverse_range = 1. / value_range if value_range > 0 else 0.
+
+    flat_image = image.ravel()
+    flat_out = out.ravel()
+    if out.dtype == np.float32:
+        _normalize(flat_image, min_image, inverse_range, flat_out)
+    else:
+        block_size = 1 << 18
+        scratch = np.empty(min(block_size, flat_image.size), dtype=np.float32)
+        for start in range(0, flat_image.size, block_size):
+            stop = min(start + block_size, flat_image.size)
+            _normalize(flat_image[start:stop], min_image, inverse_range, scratch[:stop - start])
+            flat_out[start:stop] = scratch[:stop - start]
+    return out
+
+
+def _kernel_input(image):
+    """returns a contiguous version of an image that the numba kernels can read (numba doesn't support float16:
+    float16 images are upcast to float32)
+
+    Args:
+        image (numpy.ndarray): input image
+
+    Returns:
+        (numpy.ndarray): contiguous image (image itself if it is already contiguous and supported)
+    """
+    image = np.asarray(image)
+    if image.dtype == np.float16:
+        return np.ascontiguousarray(image, dtype=np.float32)
+    return np.ascontiguousarray(image)
+
+
+def _output_buffer(image, contiguous_image, dtype):
+    """returns an output buffer for normalization, reusing the contiguous copy of the input when there is one
+
+    Args:
+        image (numpy.ndarray):            input image (as given by the caller)
+        contiguous_image (numpy.ndarray): _kernel_input(image)
+        dtype (numpy.dtype):              output type
+
+    Returns:
+        (numpy.ndarray): contiguous output buffer of image shape
+    """
+    # A contiguous copy is private to this call, it can be normalized in place (np.ascontiguousarray may also return
+    # a view of the caller's data, e.g. for a np.memmap)
+    if contiguous_image.dtype == dtype and not np.shares_memory(contiguous_image, image):
+        return contiguous_image
+    return np.empty(contiguous_image.shape, dtype=dtype)
+
+
+def normalize_image(image, p_low=0., p_high=100., out=None, dtype=np.float32):
     """normalizes an image (from the [image.min;image.max] to [0;1])
 
+    Notes:
+        with p_low/p_high, the image is normalized from [p_low percentile;p_high percentile] to [0;1] and clipped,
+        so that a few outliers don't compress the dynamic range of the whole volume (e.g. p_low=4, p_high=96)
+
     Args:
         image (numpy.ndarray): input image
+        p_low (float):         low percentile mapped to 0 (all values below will be set to 0)
+        p_high (float):        high percentile mapped to 1 (all values above will be set to 1)
+        out (numpy.ndarray):   optional contiguous output buffer of image shape, reused across calls (can be
+                               image itself if image is already float32)
+        dtype (numpy.dtype):   output type if out is not given (np.float16 halves the output size)
 
     Returns:
         (numpy.ndarray): normalized image
     """
-    max_image = np.amax(image)
-    min_image = np.amin(image)
-    image = np.asarray(image, np.float32)
+    contiguous_image = _kernel_input(image)
+    if p_low <= 0 and p_high >= 100:
+        min_image, max_image = _min_max(contiguous_image.ravel())
+    elif contiguous_image.dtype == np.uint16:
+        min_image, max_image = _percentiles_u16(contiguous_image, p_low, p_high)
+    else:
+        min_image, max_image = np.percentile(contiguous_image, [p_low, p_high])
 
-    image = (image - min_image)/(max_image - min_image)
-    return image
+    if out is None:
+        out = _output_buffer(image, contiguous_image, dtype)
+    return _normalize_into(contiguous_image, min_image, max_image, out)
 
 
-def normalize_image_min_max(image, min_image, max_image):
+def normalize_image_min_max(image, min_image, max_image, out=None, dtype=np.float32):
     """normalizes an image (from [min_image;max_image] to [0;1])
 
     Args:
         image (numpy.ndarray): input image
         min_image (float):     input image manual min value (all values below will be set to 0)
         max_image (float):     input image manual max value (all values above will be set to 1)
+        out (numpy.ndarray):   optional contiguous output buffer of image shape, reused across calls (can be
+                               image itself if image is already float32)
+        dtype (numpy.dtype):   output type if out is not given (np.float16 halves the output size)
 
     Returns:
         (numpy.ndarray): normalized image
     """
-    image = np.asarray(image, np.float32)
+    contiguous_image = _kernel_input(image)
+    if out is None:
+        out = _output_buffer(image, contiguous_image, dtype)
+    return _normalize_into(contiguous_image, min_image, max_image, out)
 
-    image = (image - min_image)/(max_image - min_image)
-    return image
+
+@jit(nopython=True, parallel=True, cache=True)
+def _block_mean_kernel(image, bin_factor, accumulator_type, floor_result, output_image):
+    """averages bin_factor^3 blocks of image into output_image (input rows are read sequentially, one output slice
+    per thread)
+
+    Args:
+        image (numpy.ndarray):        3D input image
+        bin_factor (int):             integer binning factor
+        accumulator_type (type):      type of the per-slice block sums
+        floor_result (bool):          True: block means are floored (integer images, integer accumulator)
+        output_image (numpy.ndarray): 3D output buffer (input shape // bin_factor)
+
+    Returns:
+        None
+    """
+    nb_slices, width, height = output_image.shape
+    block_size = bin_factor ** 3
+    for z in prange(nb_slices):
+        block_sums = np.zeros((width, height), dtype=accumulator_type)
+        for dz in range(bin_factor):
+            for y in range(width * bin_factor):
+                for x in range(height * bin_factor):
+                    block_sums[y // bin_factor, x // bin_factor] += image[z * bin_factor + dz, y, x]
+        for y in range(width):
+            for x in range(height):
+                if floor_result:
+                    output_image[z, y, x] = block_sums[y, x] // block_size
+                else:
+                    output_image[z, y, x] = block_sums[y, x] / block_size
+
+
+def _block_mean(image, bin_factor):
+    """bins an image by averaging bin_factor^3 blocks (trailing voxels not filling a block are dropped)
+
+    Args:
+        image (numpy.ndarray): input image
+        bin_factor (int):      integer binning factor
+
+    Returns:
+        (numpy.ndarray): binned image
+    """
+    # numba doesn't support float16: float16 images are binned in float32
+    if image.dtype == np.float16:
+        return _block_mean(image.astype(np.float32), bin_factor).astype(np.float16)
+    output_image = np.empty(tuple(dim // bin_factor for dim in image.shape), dtype=image.dtype)
+    if image.dtype.kind in "ui":
+        # Integer sums are exact: int32 when a block sum of 8/16 bit values can't overflow it, int64 otherwise
+        small_integers = image.dtype.itemsize <= 2 and bin_factor ** 3 * 2 ** 16 < 2 ** 31
+        _block_mean_kernel(image, bin_factor, np.int32 if small_integers else np.int64, True, output_image)
+    else:
+        # Float images are summed in their own type (no float64 plane)
+        _block_mean_kernel(image, bin_factor, image.dtype.type, False, output_image)
+    return output_image
+
+
+def _can_use_map_blocks_fast_path(chunks, bin_factor):
+    """checks whether every chunk of a dask array can be binned independently (all chunk sizes divisible by bin_factor)
+
+    Args:
+        chunks (tuple[tuple[int]]): dask array chunks
+        bin_factor (int):           integer binning factor
+
+    Returns:
+        (bool): True if each chunk can be binned on its own
+    """
+    return all(chunk_size % bin_factor == 0 for axis_chunks in chunks for chunk_size in axis_chunks)
+
+
+def _area_resize(image, dim):
+    """resizes a 3D image with OpenCV area interpolation (slice by slice, then along z)
+
+    Args:
+        image (numpy.ndarray): input image
+        dim (tuple[int]):      output shape
+
+    Returns:
+        (numpy.ndarray): resized image
+    """
+    nb_slices, width, height = dim
+    resized_slices = np.empty((image.shape[0], width, height), dtype=image.dtype)
+    for slice_nb in range(image.shape[0]):
+        resized_slices[slice_nb] = cv2.resize(image[slice_nb], (height, width), interpolation=cv2.INTER_AREA)
+    return cv2.resize(resized_slices.reshape(image.shape[0], width * height), (width * height, nb_slices),
+                      interpolation=cv2.INTER_AREA).reshape(dim)
 
 
 def bin_resize(image, bin_factor):
     """resizes the image depending on a bin_factor
 
+    Notes:
+        for an integer bin_factor, each output voxel is the mean of a bin_factor^3 block of input voxels (trailing
+        voxels that don't fill a complete block are dropped), otherwise the image is interpolated (OpenCV area
+        interpolation if cv2 is installed, skimage otherwise).
+        A dask array is binned lazily, chunk by chunk (rechunked first if its chunks are not divisible by bin_factor).
+
     Args:
-        image (numpy.ndarray): input image
+        image (numpy.ndarray or dask.array.Array): input image
         bin_factor (int): binning factor
 
     Returns:
@@ -83,11 +478,51 @@ def bin_resize(image, bin_factor):
         width = int(width/bin_factor)
         height = int(height/bin_factor)
         dim = (nb_slices, width, height)
+        if bin_factor == int(bin_factor):
+            bin_factor = int(bin_factor)
+            if hasattr(image, "map_blocks"):
+                if not _can_use_map_blocks_fast_path(image.chunks, bin_factor):
+                    image = image[:nb_slices * bin_factor, :width * bin_factor, :height * bin_factor]
+                    image = image.rechunk(tuple(max(bin_factor, axis_chunks[0] // bin_factor * bin_factor)
+                                                for axis_chunks in image.chunks))
+                new_chunks = tuple(tuple(chunk_size // bin_factor for chunk_size in axis_chunks)
+                                   for axis_chunks in image.chunks)
+                return image.map_blocks(_block_mean, bin_factor, dtype=image.dtype, chunks=new_chunks)
+            return _block_mean(image, bin_factor)
+        if cv2 is not None and image.dtype in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+            return _area_resize(np.asarray(image), dim)
         return resize(image, dim, preserve_range=True)
     else:
         raise Exception('bin_factor must be strictly positive')
 
 
+@jit(nopython=True, parallel=True, cache=True)
+def _flip_z_and_x(input_image, output_image, tile_size=64):
+    """flips a 3D image along its first and last axes, writing the output in natural (sequential) order
+
+    Each slice is processed in tile_size x tile_size tiles (spread over threads) so that the reversed reads of a tile
+    stay in cache while the tile is written.
+
+    Args:
+        input_image (numpy.ndarray):  3D input image
+        output_image (numpy.ndarray): 3D output buffer (same shape/dtype)
+        tile_size (int):              tile side (in pixels)
+
+    Returns:
+        None
+    """
+    nb_slices, height, width = input_image.shape
+    nb_y_tiles = (height + tile_size - 1) // tile_size
+    nb_x_tiles = (width + tile_size - 1) // tile_size
+    for tile_nb in prange(nb_slices * nb_y_tiles * nb_x_tiles):
+        z = tile_nb // (nb_y_tiles * nb_x_tiles)
+        y_start = (tile_nb // nb_x_tiles) % nb_y_tiles * tile_size
+        x_start = tile_nb % nb_x_tiles * tile_size
+        for y in range(y_start, min(y_start + tile_size, height)):
+            for x in range(x_start, min(x_start + tile_size, width)):
+                output_image[z, y, x] = input_image[nb_slices - 1 - z, y, width - 1 - x]
+
+
 def flip_along_z_axis(input_image):
     """flips an image along z axis
 
@@ -97,49 +532,154 @@ def flip_along_z_axis(input_image):
     Returns:
         (numpy.ndarray): flipped image
     """
-    return np.copy(np.flip(np.flipud(input_image), axis=2))
+    # The tiled kernel handles 3D images of numba supported types (not float16)
+    if input_image.ndim != 3 or input_image.dtype == np.float16 or input_image.dtype.kind not in "buif":
+        return np.ascontiguousarray(input_image[::-1, :, ::-1])
+    output_image = np.empty_like(input_image)
+    _flip_z_and_x(input_image, output_image)
+    return output_image
+
 
+def _linear_resample_axis(image, axis, scale, offset, output_size, xp=np):
+    """linearly resamples an image along one axis (output index i is taken at input coordinate i * scale + offset)
 
-def resize_image(moving_image, reference_image):
+    Args:
+        image (numpy.ndarray): input image
+        axis (int):            resampled axis
+        scale (float):         input/output sampling ratio
+        offset (float):        input coordinate of the first output index
+        output_size (int):     output size along axis
+        xp (module):           array module of image (numpy, or cupy for GPU arrays)
+
+    Returns:
+        (numpy.ndarray): resampled image (0 more than half a pixel outside of the input image)
+    """
+    input_size = image.shape[axis]
+    coordinates = xp.arange(output_size) * scale + offset
+    # As in SimpleITK, samples up to half a pixel outside of the input image are clamped to the edge pixel, samples
+    # further away are set to 0
+    inside = (coordinates >= -0.5) & (coordinates < input_size - 0.5)
+    coordinates = xp.clip(coordinates, 0, input_size - 1)
+    lower_indices = xp.floor(coordinates).astype(np.intp)
+    upper_indices = xp.minimum(lower_indices + 1, input_size - 1)
+    # float32 images are interpolated in float32, integer images in float64 (as SimpleITK does)
+    weights_type = np.float32 if image.dtype in (np.float16, np.float32) else np.float64
+    upper_weights = xp.where(inside, coordinates - lower_indices, 0.).astype(weights_type)
+    lower_weights = xp.where(inside, 1. - upper_weights, 0.).astype(weights_type)
+
+    weights_shape = [1] * image.ndim
+    weights_shape[axis] = output_size
+    return xp.take(image, lower_indices, axis=axis) * lower_weights.reshape(weights_shape) \
+        + xp.take(image, upper_indices, axis=axis) * upper_weights.reshape(weights_shape)
+
+
+def resize_image(moving_image, reference_image, backend="numpy"):
     """resizes volume based on reference image
 
     Args:
         moving_image (numpy.ndarray):   image to resize
         reference_image (numpy.ndarray: image to resize on
+        backend (str):                  "numpy": separable (linear) resampling on numpy arrays, "cuda": same
+                                        resampling on GPU (requires cupy), "sitk": SimpleITK resampling (all three
+                                        follow SimpleITK at the borders and truncate integer images)
 
     Returns:
         (numpy.ndarray, numpy.ndarray): resized image and ref image
     """
+    # Same mapping as the SimpleITK transform below (axis scaling + 1 slice z translation), no itk round-trip
+    scale = np.array(moving_image.shape) / np.array(reference_image.shape)
+    if backend in ("numpy", "cuda"):
+        if backend == "cuda":
+            import cupy as xp
+        else:
+            xp = np
+        # The transform is axis-aligned: trilinear interpolation = three successive 1D linear interpolations
+        # (axes that shrink the most are resampled first to keep intermediate volumes small)
+        offset = (1, 0, 0)
+        resized_image = xp.asarray(moving_image)
+        for axis in np.argsort(-scale):
+            resized_image = _linear_resample_axis(resized_image, axis, scale[axis], offset[axis],
+                                                  reference_image.shape[axis], xp)
+        # Integer images are truncated when cast back to their type, as SimpleITK does
+        resized_image = resized_image.astype(moving_image.dtype, copy=False)
+        if backend == "cuda":
+            resized_image = xp.asnumpy(resized_image)
+        return resized_image, reference_image
+    elif backend != "sitk":
+        raise Exception('Error: unknown backend ' + str(backend) + ' (numpy, cuda or sitk)')
+
+    # The reference image is only needed for its shape
     moving_image_itk = Sitk.GetImageFromArray(moving_image)
-    reference_image_itk = Sitk.GetImageFromArray(reference_image)
 
-    dimension = reference_image_itk.GetDimension()
+    dimension = moving_image.ndim
 
-    reference_physical_size = np.zeros(dimension)
-    reference_physical_size[:] = [(sz - 1) * spc if sz * spc > mx else mx for sz, spc, mx in
-                                  zip(reference_image_itk.GetSize(), reference_image_itk.GetSpacing(), reference_physical_size)]
+    itk_size = np.array(reference_image.shape[::-1], dtype=np.float64)
+    itk_spacing = np.ones(dimension)
+    reference_physical_size = np.where(itk_size * itk_spacing > 0, (itk_size - 1) * itk_spacing, 0.)
 
     # Create the reference image with a zero origin, identity direction cosine matrix and dimension
     reference_origin = np.zeros(dimension)
     reference_direction = np.identity(dimension).flatten()
     reference_size = [reference_image.shape[2], reference_image.shape[1],
                       reference_image.shape[0]]  # Arbitrary sizes, smallest size that yields desired results.
-    reference_spacing = [phys_sz / (sz - 1) for sz, phys_sz in zip(reference_size, reference_physical_size)]
+    reference_spacing = (reference_physical_size / (np.array(reference_size, dtype=np.float64) - 1)).tolist()
 
-    reference_image = Sitk.Image(reference_size, moving_image_itk.GetPixelIDValue())
-    reference_image.SetOrigin(reference_origin)
-    reference_image.SetSpacing(reference_spacing)
-    reference_image.SetDirection(reference_direction)
+    reference_grid_itk = Sitk.Image(reference_size, moving_image_itk.GetPixelIDValue())
+    reference_grid_itk.SetOrigin(reference_origin)
+    reference_grid_itk.SetSpacing(reference_spacing)
+    reference_grid_itk.SetDirection(reference_direction)
 
     # Modify the transformation to align the centers of the original and reference image instead of their origins.
     centering_transform = Sitk.AffineTransform(dimension)
-    centering_transform.Scale((moving_image.shape[2] / reference_image.shape[2], moving_image.shape[1] / reference_image.shape[1],
-                               moving_image.shape[0] / reference_image.shape[0]))
+    centering_transform.Scale((moving_image.shape[2] / reference_size[0], moving_image.shape[1] / reference_size[1],
+                               moving_image.shape[0] / reference_size[2]))
 
     centering_transform.SetTranslation((0, 0, 1))
-    moving_image_itk = Sitk.Resample(moving_image_itk, reference_image, centering_transform, Sitk.sitkLinear, 0.0)
+    moving_image_itk = Sitk.Resample(moving_image_itk, reference_grid_itk, centering_transform, Sitk.sitkLinear, 0.0)
 
-    # Start of registration declaration
     moving_image = Sitk.GetArrayFromImage(moving_image_itk)
-    reference_image = Sitk.GetArrayFromImage(reference_image_itk)
     return moving_image, reference_image
+
+
+@jit(nopython=True, parallel=True, fastmath=True, cache=True)
+def _interpolate(first_image, second_image, interpolation_weight, output_image):
+    """linear interpolation between two flattened images, in a single pass
+
+    Args:
+        first_image (numpy.ndarray):  1D first image
+        second_image (numpy.ndarray): 1D second image
+        interpolation_weight (float): interpolation weight in [0;1]
+        output_image (numpy.ndarray): 1D output buffer
+
+    Returns:
+        None
+    """
+    for index in prange(output_image.size):
+        first_value = float(first_image[index])
+        output_image[index] = first_value + interpolation_weight * (float(second_image[index]) - first_value)
+
+
+def interpolate_two_images(first_image, second_image, interpolation_weight, out=None):
+    """linearly interpolates between two images: first_image + interpolation_weight * (second_image - first_image)
+
+    Args:
+        first_image (numpy.ndarray):  first image (interpolation_weight = 0)
+        second_image (numpy.ndarray): second image (interpolation_weight = 1)
+        interpolation_weight (float): interpolation weight in [0;1]
+        out (numpy.ndarray):          optional output buffer (float)
+
+    Returns:
+        (numpy.ndarray): interpolated image
+    """
+    if out is None:
+        out = np.empty(first_image.shape, dtype=np.result_type(first_image.dtype, second_image.dtype, np.float32))
+    # Contiguous images of the same shape are interpolated in a single parallel pass (the kernel doesn't broadcast)
+    if first_image.shape == second_image.shape == out.shape and first_image.flags.c_contiguous \
+            and second_image.flags.c_contiguous and out.flags.c_contiguous:
+        _interpolate(first_image.reshape(-1), second_image.reshape(-1), interpolation_weight, out.reshape(-1))
+        return out
+    # Otherwise, computed in the output buffer (no temporary image), in the output type (no integer wrap-around)
+    np.subtract(second_image, first_image, out=out, dtype=out.dtype)
+    out *= interpolation_weight
+    np.add(out, first_image, out=out, dtype=out.dtype)
+    return out
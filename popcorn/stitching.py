@@ -1,20 +1,160 @@
 import os
 import sys
 import glob
+import multiprocessing
 import shutil
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 
 from skimage import filters
 import numpy as np
+from scipy.ndimage import shift
+from numba import jit, prange, set_num_threads
 
 from popcorn.input_output import open_image, open_sequence, save_tif_image, open_cropped_sequence, save_tif_sequence, \
-    open_cropped_image, create_list_of_files
+    open_memory_mapped_image, create_list_of_files, create_directory
 from popcorn.spectral_imaging.registration import registration_computation, apply_itk_transformation
 from popcorn.resampling import interpolate_two_images
 
 # -- registration library --
 import SimpleITK as Sitk
 
+# Maximum number of voxels used to compute Otsu thresholds
+_OTSU_SAMPLE_SIZE = 200000
+
+# Number of concurrent file transfers (moves/copies are latency-bound on network storage)
+_TRANSFER_WORKERS = 16
+
+
+def _transfer(source_filename, output_filename, copy_mode):
+    """moves or copies a file
+
+    Args:
+        source_filename (str): input file name
+        output_filename (str): output file name
+        copy_mode (int):       0: file is moved (no backup), 1: file is copied
+
+    Returns:
+        None
+    """
+    if copy_mode == 0:
+        os.replace(source_filename, output_filename)
+    else:
+        shutil.copy2(source_filename, output_filename)
+
+
+def _transfer_list(list_to_copy, output_folder, flip, copy_mode):
+    """moves or copies a list of files in the output folder (the transfers are run concurrently)
+
+    Args:
+        list_to_copy (list[str]): input file names
+        output_folder (str):      output folder
+        flip (bool):              True: files are renamed in reverse order
+        copy_mode (int):          0: files are moved (no backup), 1: files are copied
+
+    Returns:
+        None
+    """
+    basenames = [os.path.basename(filename) for filename in list_to_copy]
+    output_filenames = [os.path.join(output_folder, basename) for basename in (basenames[::-1] if flip else basenames)]
+    with ThreadPoolExecutor(max_workers=_TRANSFER_WORKERS) as executor:
+        list(executor.map(_transfer, list_to_copy, output_filenames, repeat(copy_mode)))
+
+
+def _read_ahead(filenames_per_step):
+    """yields the images of each step, the images of the next step are read (in threads) while a step is processed
+
+    Args:
+        filenames_per_step (list[list[str]]): file names of the images of each step
+
+    Yields:
+        (list[numpy.ndarray]): images of the current step
+    """
+    if len(filenames_per_step) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=max(len(filenames) for filenames in filenames_per_step)) as executor:
+        next_images = [executor.submit(open_image, filename) for filename in filenames_per_step[0]]
+        for step in range(len(filenames_per_step)):
+            images = [image.result() for image in next_images]
+            if step + 1 < len(filenames_per_step):
+                next_images = [executor.submit(open_image, filename) for filename in filenames_per_step[step + 1]]
+            yield images
+
+
+def _list_images(folder):
+    """lists (sorted) the tif/tiff/edf/png images of a folder in a single directory scan (extensions of any case)
+
+    Args:
+        folder (str): input folder
+
+    Returns:
+        (list[str]): sorted list of image filenames
+    """
+    with os.scandir(folder) as entries:
+        filenames = [entry.path for entry in entries
+                     if not entry.name.startswith('.')
+                     and entry.name.lower().endswith(('.tif', '.tiff', '.edf', '.png')) and entry.is_file()]
+    filenames.sort()
+    return filenames
+
+
+def _init_worker():
+    """initializes a worker process: numba kernels run on a single thread, the worker processes already share the cores
+
+    Returns:
+        None
+    """
+    set_num_threads(1)
+
+
+def _process_pool(max_workers):
+    """creates a pool of worker processes (spawned: forking a process that already ran parallel numba kernels can
+    hang), each one running single-threaded numba kernels so that the workers don't oversubscribe the cores
+
+    Args:
+        max_workers (int): number of worker processes
+
+    Returns:
+        (concurrent.futures.ProcessPoolExecutor): process pool
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker)
+
+
+def _open_band(band_filenames, cached_filenames, cached_band_image):
+    """opens a band of slices, reusing the slices already decoded in a cached band
+
+    Args:
+        band_filenames (list[str]):         file names of the band slices
+        cached_filenames (list[str]):       file names of the cached band slices
+        cached_band_image (numpy.ndarray):  cached band (None if no band is cached)
+
+    Returns:
+        (numpy.ndarray): band of slices
+    """
+    cached_indices = {filename: index for index, filename in enumerate(cached_filenames)} \
+        if cached_band_image is not None else {}
+    missing_filenames = [filename for filename in band_filenames if filename not in cached_indices]
+
+    if len(missing_filenames) == len(band_filenames):
+        return open_sequence(band_filenames)
+    if len(missing_filenames) == 0:
+        return cached_band_image[[cached_indices[filename] for filename in band_filenames]]
+
+    # Only the slices that are not cached are read from disk
+    missing_band_image = open_sequence(missing_filenames)
+    band_image = np.empty((len(band_filenames),) + missing_band_image.shape[1:], dtype=missing_band_image.dtype)
+    missing_index = 0
+    for index, filename in enumerate(band_filenames):
+        if filename in cached_indices:
+            band_image[index] = cached_band_image[cached_indices[filename]]
+        else:
+            band_image[index] = missing_band_image[missing_index]
+            missing_index += 1
+    return band_image
+
+
 def stitch_multiple_folders_into_one(list_of_folders, output_folder, delta_z, look_for_best_slice=True, copy_mode=0,
                                      security_band_size=10, overlap_mode=0, band_average_size=0, flip=False):
     """Function that stitches different folders into a unique one.
@@ -41,35 +181,37 @@ def stitch_multiple_folders_into_one(list_of_folders, output_folder, delta_z, lo
     bottom_overlap_index = 0
     top_overlap_index = 0
 
+    # Band sizes are converted once (integer slice offsets)
+    security_band_size = int(security_band_size)
+    half_band_average_size = int(band_average_size) // 2
+
+    # Every folder is listed once, the top folder listing is reused as bottom folder listing at the next step
+    all_listings = [_list_images(folder_name) for folder_name in list_of_folders]
+    if flip:
+        for listing in all_listings:
+            listing.reverse()
+
+    # The top band of a step is kept: its slices are reused if the next bottom band overlaps it
+    previous_top_band_filenames = []
+    previous_top_band_image = None
+
     # Parsing all input folders
     for folder_name in list_of_folders:
         print("Stitching step ", str(folder_nb) + "/", str(len(list_of_folders)))
 
         # We retrieve the list of filenames in the very first folder
-        bottom_image_filenames = glob.glob(folder_name + '/*.tif') + glob.glob(folder_name + '/*.edf') \
-                                 + glob.glob(folder_name + '/*.png')
-
-        if flip:
-            bottom_image_filenames.sort(reverse=True)
-        else:
-            bottom_image_filenames.sort()
-
+        bottom_image_filenames = all_listings[folder_nb]
         nb_slices = len(bottom_image_filenames)
 
         # We compute stitching on all folders (N folders implies N-1 stitching computations)
         if folder_nb < number_of_folders - 1:
             # We retrieve the list of filenames for the folder next to the current one
-            top_image_filenames = glob.glob(list_of_folders[folder_nb + 1] + '/*.tif') \
-                                  + glob.glob(list_of_folders[folder_nb + 1] + '/*.edf') \
-                                  + glob.glob(list_of_folders[folder_nb + 1] + '/*.png')
-            if flip:
-                top_image_filenames.sort(reverse=True)
-            else:
-                top_image_filenames.sort()
+            top_image_filenames = all_listings[folder_nb + 1]
 
             # We use delta_z to determine the theoretical overlapping slice index
-            supposed_bottom_overlap_slice = nb_slices - int((nb_slices - delta_z) / 2)
-            supposed_top_overlap_slice = int((nb_slices - delta_z) / 2)
+            half_non_overlapping_size = int(nb_slices - delta_z) // 2
+            supposed_bottom_overlap_slice = nb_slices - half_non_overlapping_size
+            supposed_top_overlap_slice = half_non_overlapping_size
 
             # We're computing stitching on a band (not only one image)
             if security_band_size > 0:
@@ -77,15 +219,17 @@ def stitch_multiple_folders_into_one(list_of_folders, output_folder, delta_z, lo
                 if look_for_best_slice:
                     # We only keep the filenames of the bands used for stitching computation
                     bottom_band_filenames = \
-                        bottom_image_filenames[supposed_bottom_overlap_slice - int(security_band_size):
-                                               supposed_bottom_overlap_slice + int(security_band_size)]
+                        bottom_image_filenames[supposed_bottom_overlap_slice - security_band_size:
+                                               supposed_bottom_overlap_slice + security_band_size]
                     top_band_filenames = \
-                        top_image_filenames[supposed_top_overlap_slice - int(security_band_size):
-                                            supposed_top_overlap_slice + int(security_band_size)]
+                        top_image_filenames[supposed_top_overlap_slice - security_band_size:
+                                            supposed_top_overlap_slice + security_band_size]
 
-                    # We load the corresponding bands
-                    bottom_band_image = open_sequence(bottom_band_filenames)
+                    # We load the corresponding bands (already decoded slices of the previous top band are reused)
+                    bottom_band_image = _open_band(bottom_band_filenames, previous_top_band_filenames,
+                                                   previous_top_band_image)
                     top_band_image = open_sequence(top_band_filenames)
+                    previous_top_band_filenames, previous_top_band_image = top_band_filenames, top_band_image
 
                     # Stitching computation. Returns the overlapping slices index between given bands
                     overlap_index = int(look_for_maximum_correlation_band(bottom_band_image, top_band_image, 10, True))
@@ -99,66 +243,37 @@ def stitch_multiple_folders_into_one(list_of_folders, output_folder, delta_z, lo
                 # We compute for overlap index for the current folder
                 bottom_overlap_index = supposed_bottom_overlap_slice + overlap_index_difference
 
-                # List of filenames from current folder we need to copy
+                # List of filenames from current folder we need to copy, we either copy or move them (depending on
+                # copy_mode)
                 list_to_copy = bottom_image_filenames[top_overlap_index:bottom_overlap_index]
+                _transfer_list(list_to_copy, output_folder, flip, copy_mode)
 
                 # If we do not average images
                 if overlap_mode == 0:
-                    for slice_index in range(0, len(list_to_copy)):
-                        # If the filenames are in reverse order
-                        if flip == 1:
-                            output_filename = output_folder + '/' + os.path.basename(list_to_copy[-(slice_index + 1)])
-                        else:
-                            output_filename = output_folder + '/' + os.path.basename(list_to_copy[slice_index])
-                        # We either copy or move files depending on copy_mode
-                        if copy_mode == 0:
-                            os.rename(list_to_copy[slice_index], output_filename)
-                        else:
-                            shutil.copy2(list_to_copy[slice_index], output_filename)
-
                     # In case of no average, the overlapping index in the next folder is the supposed one
                     top_overlap_index = supposed_top_overlap_slice
                 else:
-                    for slice_index in range(0, len(list_to_copy)):
-                        # If the filenames are in reverse order
-                        if flip:
-                            output_filename = output_folder + '/' + os.path.basename(list_to_copy[-(slice_index + 1)])
-                        else:
-                            output_filename = output_folder + '/' + os.path.basename(list_to_copy[slice_index])
-
-                        # We either copy or move files depending on copy_mode
-                        if copy_mode == 0:
-                            os.rename(list_to_copy[slice_index], output_filename)
-                        else:
-                            shutil.copy2(list_to_copy[slice_index], output_filename)
-
                     # We retrieve the filenames used for averaging
+                    top_average_center = supposed_top_overlap_slice + overlap_index_difference
                     bottom_average_filenames = \
-                        bottom_image_filenames[bottom_overlap_index - int(band_average_size / 2):
-                                               bottom_overlap_index + int(band_average_size / 2)]
+                        bottom_image_filenames[bottom_overlap_index - half_band_average_size:
+                                               bottom_overlap_index + half_band_average_size]
 
                     top_average_filenames = \
-                        top_image_filenames[supposed_top_overlap_slice +
-                                            overlap_index_difference - int(band_average_size / 2):
-                                            supposed_top_overlap_slice +
-                                            overlap_index_difference + int(band_average_size / 2)]
+                        top_image_filenames[top_average_center - half_band_average_size:
+                                            top_average_center + half_band_average_size]
                     # We compute the average between the two images depending on
                     averaged_image = average_images_from_filenames(bottom_average_filenames, top_average_filenames,
                                                                    overlap_mode)
-                    # We save the averaged images
-                    list_of_new_filenames = bottom_image_filenames[bottom_overlap_index - int(band_average_size / 2):
-                                                                   bottom_overlap_index + int(band_average_size / 2)]
-
-                    for filename in list_of_new_filenames:
-                        output_filename = output_folder + os.path.basename(filename)
-                        for i in range(0, band_average_size):
-                            slice_data = averaged_image[i, :, :].squeeze()
-                            save_tif_image(slice_data.astype(np.uint16), output_filename, bit=16)
+                    # We save the averaged images (clipped to the uint16 range and converted once for the whole band)
+                    list_of_new_filenames = bottom_average_filenames
+                    np.clip(averaged_image, 0, 65535, out=averaged_image)
+                    save_tif_sequence(averaged_image.astype(np.uint16), output_folder, bit=16,
+                                      filenames=list_of_new_filenames)
 
                     # In case of no average, the overlapping index in the next folder is
                     # the supposed one + half of average band
-                    top_overlap_index = supposed_top_overlap_slice + overlap_index_difference + int(
-                        band_average_size / 2)
+                    top_overlap_index = top_average_center + half_band_average_size
 
             # If the security_band_size is not > 0
             else:
@@ -166,18 +281,8 @@ def stitch_multiple_folders_into_one(list_of_folders, output_folder, delta_z, lo
         # Once we computed stitching on all folders, we copy the remaining files (from the last folder)
         else:
             list_to_copy = bottom_image_filenames[top_overlap_index:-1]
-            for slice_index in range(0, len(list_to_copy)):
-                # If the filenames are in reverse order
-                if flip:
-                    output_filename = output_folder + '/' + os.path.basename(list_to_copy[-(slice_index + 1)])
-                else:
-                    output_filename = output_folder + '/' + os.path.basename(list_to_copy[slice_index])
-
-                # We either copy or move files depending on copy_mode
-                if copy_mode == 0:
-                    os.rename(list_to_copy[slice_index], output_filename)
-                else:
-                    shutil.copy2(list_to_copy[slice_index], output_filename)
+            # We either copy or move files (depending on copy_mode)
+            _transfer_list(list_to_copy, output_folder, flip, copy_mode)
         print(" > corresponding slices found: slice", bottom_overlap_index, "and slice", top_overlap_index)
         folder_nb += 1
 
@@ -193,16 +298,15 @@ def average_images_from_filenames(first_image_filenames, second_image_filenames,
     Returns:
         numpy.ndarray: averaged image
     """
-    # Opens image
-    first_image = open_sequence(first_image_filenames)
+    # Opens image (float32)
+    first_image = open_sequence(first_image_filenames).astype(np.float32, copy=False)
     second_image = open_sequence(second_image_filenames)
 
-    # If standard average requested
-    if mode == 1:
-        return (first_image + second_image) / 2
-    # If weighted average requested
-    else:
-        return (first_image + second_image) / 2
+    # Standard average, computed in place in the first image (the weighted average is not implemented yet: mode is
+    # not used)
+    np.add(first_image, second_image, out=first_image)
+    first_image *= 0.5
+    return first_image
 
 
 def look_for_maximum_correlation(first_image, second_image):
@@ -225,27 +329,20 @@ def look_for_maximum_correlation(first_image, second_image):
 
     middle_slice = int(first_nb_slices / 2)
 
-    # We compute what we need for normalized cross correlation (first image middle slice)
-    first_image_middle_slice = np.copy(first_image[middle_slice, :, :].squeeze())
-    first_image_middle_slice = first_image_middle_slice - np.mean(first_image_middle_slice)
+    # We compute what we need for normalized cross correlation (first image middle slice), in float32
+    first_image_middle_slice = first_image[middle_slice, :, :].astype(np.float32)
+    first_image_middle_slice -= np.mean(first_image_middle_slice)
     first_image_middle_slice_std = np.std(first_image_middle_slice)
 
-    # We compute what we need for normalized cross correlation (second image)
-    centered_second_image = np.copy(second_image)
-    for slice_nb in range(second_nb_slices):
-        centered_second_image[slice_nb, :, :] = centered_second_image[slice_nb, :, :] \
-                                                - np.mean(centered_second_image[slice_nb, :, :])
-    centered_images_multiplication_result = first_image_middle_slice * centered_second_image
+    # We compute what we need for normalized cross correlation (second image), one row per slice
+    centered_second_image = second_image.reshape(second_nb_slices, -1).astype(np.float32)
+    centered_second_image -= centered_second_image.mean(axis=1, keepdims=True)
+    second_image_stds = _row_stds(centered_second_image)
 
     # We compute normalized cross-correlation between first image middle slice and all second image slices
-    normalized_cross_correlations = np.zeros(second_nb_slices)
-    for slice_nb in range(0, second_nb_slices):
-        second_image_slice_std = np.std(centered_second_image[slice_nb, :, :])
-        sum_of_multiplied_images = np.sum(centered_images_multiplication_result[slice_nb, :, :])
-        normalized_cross_correlation = sum_of_multiplied_images / (
-                    first_image_middle_slice_std * second_image_slice_std)
-        normalized_cross_correlation /= (width * height)
-        normalized_cross_correlations[slice_nb] = normalized_cross_correlation  # array of normalized-cross correlations
+    # (a single matrix-vector product)
+    normalized_cross_correlations = centered_second_image @ first_image_middle_slice.ravel() \
+        / (first_image_middle_slice_std * second_image_stds) / (width * height)
 
     # The best candidate corresponds to the nb with max normalized cross-correlation
     best_corresponding_slice_nb = np.argmax(normalized_cross_correlations)
@@ -253,6 +350,70 @@ def look_for_maximum_correlation(first_image, second_image):
     return best_corresponding_slice_nb
 
 
+@jit(nopython=True, parallel=True, cache=True)
+def _row_stds(rows):
+    """computes the standard deviation of every row of a 2D array in a single pass (no temporary array)
+
+    Args:
+        rows (numpy.ndarray): 2D input array (one row per slice)
+
+    Returns:
+        (numpy.ndarray): standard deviation of each row
+    """
+    nb_rows, row_size = rows.shape
+    stds = np.empty(nb_rows, dtype=rows.dtype)
+    for row_nb in prange(nb_rows):
+        row_sum = 0.
+        row_square_sum = 0.
+        for index in range(row_size):
+            value = rows[row_nb, index]
+            row_sum += value
+            row_square_sum += value * value
+        row_mean = row_sum / row_size
+        stds[row_nb] = np.sqrt(max(row_square_sum / row_size - row_mean * row_mean, 0.))
+    return stds
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _masked_center_slices(image, mask, centered_image):
+    """centers every slice of a masked image on the mean of its positive (masked) values, the result is masked
+
+    The standard deviation of every centered slice is accumulated while it is written (no extra pass over the image)
+
+    Args:
+        image (numpy.ndarray):          3D input image
+        mask (numpy.ndarray):           3D boolean mask
+        centered_image (numpy.ndarray): 3D output buffer
+
+    Returns:
+        (numpy.ndarray): standard deviation of each centered slice
+    """
+    nb_slices, width, height = image.shape
+    slice_size = width * height
+    stds = np.empty(nb_slices, dtype=centered_image.dtype)
+    for slice_nb in prange(nb_slices):
+        positive_sum = 0.
+        positive_count = 0
+        for y in range(width):
+            for x in range(height):
+                value = mask[slice_nb, y, x] * image[slice_nb, y, x]
+                if value > 0.:
+                    positive_sum += value
+                    positive_count += 1
+        positive_mean = positive_sum / positive_count if positive_count > 0 else np.nan
+        centered_sum = 0.
+        centered_square_sum = 0.
+        for y in range(width):
+            for x in range(height):
+                centered_image[slice_nb, y, x] = mask[slice_nb, y, x] * (image[slice_nb, y, x] - positive_mean)
+                centered_value = centered_image[slice_nb, y, x]
+                centered_sum += centered_value
+                centered_square_sum += centered_value * centered_value
+        centered_mean = centered_sum / slice_size
+        stds[slice_nb] = np.sqrt(max(centered_square_sum / slice_size - centered_mean * centered_mean, 0.))
+    return stds
+
+
 def look_for_maximum_correlation_band(first_image, second_image, band_size, with_segmentation=True):
     """Looks for the maximum correlated slice between two images
 
@@ -268,60 +429,52 @@ def look_for_maximum_correlation_band(first_image, second_image, band_size, with
         int: the slice number with highest zero normalized cross correlation.
     """
     nb_slices, width, height = first_image.shape
-    mask = np.zeros(first_image.shape)
     middle_slice_nb = int(nb_slices / 2)
 
-    first_image_copy = np.copy(first_image)
-    centered_second_image = np.copy(second_image)
+    # Slices of first_image[-band_size/2: band_size/2] used for computation
+    band_offsets = np.arange(int(-band_size / 2), int(band_size / 2))
+    band = slice(middle_slice_nb + int(-band_size / 2), middle_slice_nb + int(band_size / 2))
+    if band.start < 0 or band.stop > nb_slices:
+        raise Exception('Error: band of ' + str(band_size) + ' slices does not fit in the ' + str(nb_slices)
+                        + ' slices of the first image')
 
+    # Every computation (means, stds, products) is performed in float32
     # If a thresholding is requested, we use Otsu thresholding on top 85% of the first image histogram
+    # (computed on a regular subsample of the first image voxels)
     if with_segmentation:
-        thresh = filters.threshold_otsu(first_image_copy[first_image_copy > 0.15 * np.amax(first_image_copy)])
-        if (first_image_copy[first_image_copy > thresh]).size / first_image_copy.size < 0.005:
-            thresh = filters.threshold_otsu(first_image_copy)
-        mask = first_image_copy > thresh
-        first_image_copy = mask * first_image_copy
-        centered_second_image = mask * centered_second_image
-
-    # We compute what we need for normalized cross correlation (second image)
-    for slice_nb in range(nb_slices):
-        second_image_slice = centered_second_image[slice_nb, :, :]
-        if with_segmentation:
-            centered_second_image[slice_nb, :, :] = \
-                mask[slice_nb, :, :] * (second_image_slice - np.mean(second_image_slice[second_image_slice > 0.0]))
-        else:
-            centered_second_image[slice_nb, :, :] = centered_second_image[slice_nb, :, :] \
-                                                    - np.mean(centered_second_image[slice_nb, :, :])
-
-    # We parse every slice of first_image[-band_size/2: band_size/2]
+        flat_first_image = first_image.reshape(-1)
+        first_image_sample = flat_first_image[::max(1, -(-flat_first_image.size // _OTSU_SAMPLE_SIZE))]
+        thresh = filters.threshold_otsu(first_image_sample[first_image_sample > 0.15 * np.amax(flat_first_image)])
+        if np.count_nonzero(first_image_sample > thresh) / first_image_sample.size < 0.005:
+            thresh = filters.threshold_otsu(first_image_sample)
+        mask = first_image > thresh
+
+        # Every slice is centered on the mean of its masked (positive) values, then masked
+        centered_second_image = np.empty(second_image.shape, dtype=np.float32)
+        second_image_stds = _masked_center_slices(second_image, mask, centered_second_image)
+        centered_first_band = np.empty((band_offsets.size, width, height), dtype=np.float32)
+        first_band_stds = _masked_center_slices(first_image[band], mask[band], centered_first_band)
+    # In case of no thresholding, we don't use the mask for computation
+    else:
+        centered_second_image = second_image.astype(np.float32)
+        centered_second_image -= centered_second_image.mean(axis=(1, 2), keepdims=True)
+        centered_first_band = first_image[band].astype(np.float32)
+        centered_first_band -= centered_first_band.mean(axis=(1, 2), keepdims=True)
+        second_image_stds = _row_stds(centered_second_image.reshape(nb_slices, -1))
+        first_band_stds = _row_stds(centered_first_band.reshape(band_offsets.size, -1))
+
+    # One row per slice
+    centered_second_image = centered_second_image.reshape(nb_slices, -1)
+    centered_first_band = centered_first_band.reshape(band_offsets.size, -1)
+
+    # Normalized cross-correlations between every band slice and every second image slice (a single matrix product)
+    normalized_cross_correlations = centered_first_band @ centered_second_image.T \
+        / np.outer(first_band_stds, second_image_stds) / (width * height)
+
+    # We store the best candidate for overlapping slice for each first image slice.
     best_slice_candidates = np.zeros(band_size)
-    for i in range(int(-band_size / 2), (int(band_size / 2))):
-        first_image_middle_slice = first_image_copy[middle_slice_nb + i, :, :].squeeze()
-        # In case of thresholding, we use the computed mask on the current slice for computation
-        if with_segmentation:
-            first_image_middle_slice = \
-                mask[middle_slice_nb + i, :, :] * \
-                (first_image_middle_slice - np.mean(first_image_middle_slice[first_image_middle_slice > 0.0]))
-        # In case of no thresholding, we don't use the mask for computation
-        else:
-            first_image_middle_slice = first_image_middle_slice - np.mean(first_image_middle_slice)
-        first_image_middle_slice_std = np.std(first_image_middle_slice)
-        normalized_cross_correlations = np.zeros(nb_slices)
-        centered_images_multiplication_result = first_image_middle_slice * centered_second_image
-
-        # We parse every slice of second image to compute normalized cross-correlations
-        for slice_nb in range(nb_slices):
-            centered_second_image_std = np.std(centered_second_image[slice_nb, :, :])
-            sum_of_multiplied_images = np.sum(centered_images_multiplication_result[slice_nb, :, :])
-
-            normalized_cross_correlation = \
-                sum_of_multiplied_images / (first_image_middle_slice_std * centered_second_image_std)
-            normalized_cross_correlation /= (width * height)
-            normalized_cross_correlations[slice_nb] = normalized_cross_correlation  # arrays of normalized cross-corr
-
-        # We store the best candidate for overlapping slice for each first image slice.
-        best_corresponding_slice_nb = np.argmax(normalized_cross_correlations) - i
-        best_slice_candidates[i + int(band_size / 2)] = best_corresponding_slice_nb
+    best_slice_candidates[band_offsets + int(band_size / 2)] = \
+        np.argmax(normalized_cross_correlations, axis=1) - band_offsets
 
     # We finally retrieve the final best candidate (victory royale)
     computed_corresponding_slice_nb = np.median(best_slice_candidates)
@@ -339,37 +492,70 @@ def rearrange_folders_list(starting_position, number_of_lines, number_of_columns
     Returns (list[int]): list of sorted indices
 
     """
-    list_of_folders = list(range(number_of_lines * number_of_columns))
-    for nb_line in range(number_of_lines):
-        if (nb_line + ("left" in starting_position) * 1) % 2 == 0:
-            list_of_folders[nb_line * number_of_columns: nb_line * number_of_columns + number_of_columns] = \
-                list(reversed(
-                    list_of_folders[nb_line * number_of_columns: nb_line * number_of_columns + number_of_columns]))
+    grid = np.arange(number_of_lines * number_of_columns).reshape(number_of_lines, number_of_columns)
 
+    # Serpentine order: every other line is read backwards (odd lines when starting on the left, even lines otherwise)
+    first_reversed_line = 1 if "left" in starting_position else 0
+    grid[first_reversed_line::2] = grid[first_reversed_line::2, ::-1]
+
+    # Lines are taken from the bottom of the grid
     if "bottom" in starting_position:
-        new_list_of_folders = list(range(1, number_of_lines * number_of_columns + 1))
-        for nb_line in range(number_of_lines):
-            if nb_line * number_of_columns > 0:
-                new_list_of_folders[nb_line * number_of_columns:
-                                    nb_line * number_of_columns + number_of_columns] = \
-                    list_of_folders[-(nb_line * number_of_columns + number_of_columns):
-                                    -(nb_line * number_of_columns)]
-            else:
-                new_list_of_folders[nb_line * number_of_columns:
-                                    nb_line * number_of_columns + number_of_columns] = \
-                    list_of_folders[-(nb_line * number_of_columns + number_of_columns):]
-    else:
-        new_list_of_folders = list_of_folders
-    return new_list_of_folders
+        grid = grid[::-1]
+    return grid.ravel().tolist()
 
 
-def two_dimensions_stitching(ref_image, moving_image, supposed_offset=[0, 0]):
+def _translate_image(image, translation, backend="sitk"):
+    """translates a 2D/3D image with linear interpolation (same mapping as a SimpleITK TranslationTransform)
+
+    Args:
+        image (numpy.ndarray):     input image
+        translation (list[float]): translation [x, y] or [x, y, z]
+        backend (str):             "sitk": SimpleITK resampling, "numpy": scipy resampling, "cuda": same resampling on
+                                   GPU (requires cupy)
+
+    Returns:
+        (numpy.ndarray): translated image
+    """
+    if backend == "sitk":
+        transformation = Sitk.TranslationTransform(len(translation))
+        transformation.SetParameters(tuple(translation))
+        return apply_itk_transformation(image, transformation)
+
+    if backend == "cuda":
+        import cupy as xp
+        from cupyx.scipy.ndimage import shift as image_shift
+    elif backend == "numpy":
+        xp = np
+        image_shift = shift
+    else:
+        raise Exception('Error: unknown backend ' + str(backend) + ' (sitk, numpy or cuda)')
+
+    # SimpleITK translations are given in (x, y[, z]) order, array axes are ([z,] y, x)
+    axes_translation = [float(axis_translation) for axis_translation in reversed(translation)]
+    # Integer images are interpolated in float64 and truncated when cast back to their type, as SimpleITK does
+    input_image = xp.asarray(image, dtype=np.float64) if image.dtype.kind in "iu" else xp.asarray(image)
+    translated_image = image_shift(input_image, [-axis_translation for axis_translation in axes_translation],
+                                   order=1, mode='nearest', prefilter=False)
+    # As in SimpleITK, samples more than half a pixel outside of the input image are set to 0
+    for axis, axis_translation in enumerate(axes_translation):
+        coordinates = xp.arange(image.shape[axis]) + axis_translation
+        outside = (coordinates < -0.5) | (coordinates >= image.shape[axis] - 0.5)
+        translated_image[(slice(None),) * axis + (outside,)] = 0
+    translated_image = translated_image.astype(image.dtype, copy=False)
+
+    if backend == "cuda":
+        translated_image = xp.asnumpy(translated_image)
+    return translated_image
+
+
+def two_dimensions_stitching(ref_image, moving_image, supposed_offset=[0, 0], backend="sitk"):
     """ Stitches 2 slices and combines them together
         supposed_offset : position of a pixel in ref_image - position of the same pixel in moving image
     Args:
         ref_image (numpy.ndarray):    reference image
         moving_image (numpy.ndarray): moving image
         supposed_offset (list[int]):  supposed offset between ref and moving image [x, y]
+        backend (str):                moving image translations, "sitk": SimpleITK, "numpy": scipy, "cuda": GPU (cupy)
 
     Returns:
         (numpy.ndarray): combined images
@@ -378,7 +564,7 @@ def two_dimensions_stitching(ref_image, moving_image, supposed_offset=[0, 0]):
     initial_transform = Sitk.TranslationTransform(2)
     initial_transform.SetParameters((supposed_offset[0], supposed_offset[1]))
 
-    moving_image_copy = apply_itk_transformation(moving_image, initial_transform)
+    moving_image_copy = _translate_image(moving_image, initial_transform.GetParameters(), backend)
     transformation = registration_computation(moving_image=moving_image_copy, ref_image=ref_image,
                                               transform_type="translation",
                                               metric="cc", verbose=False)
@@ -391,7 +577,7 @@ def two_dimensions_stitching(ref_image, moving_image, supposed_offset=[0, 0]):
         transformation.SetParameters(((ref_image.shape[1] + transformation_parameters[0] + initial_transform.GetParameters()[0]),
                                       transformation_parameters[1] + initial_transform.GetParameters()[1]))
     print("actual shift :", transformation.GetParameters())
-    moving_image = apply_itk_transformation(moving_image, transformation)
+    moving_image = _translate_image(moving_image, transformation.GetParameters(), backend)
 
     output_x_size = int(2*ref_image.shape[1] - moving_image.shape[1] + int(transformation_parameters[0])
                         + abs(initial_transform.GetParameters()[0]))
@@ -401,27 +587,27 @@ def two_dimensions_stitching(ref_image, moving_image, supposed_offset=[0, 0]):
     x_difference = output_x_size - ref_image.shape[1]
     y_difference = output_y_size - ref_image.shape[0]
 
-    output_image = np.zeros((output_y_size, output_x_size))
+    output_image = np.zeros((output_y_size, output_x_size), dtype=np.result_type(ref_image, moving_image))
 
-    if abs(supposed_offset[1]) > abs(supposed_offset[0]) and supposed_offset[1] > 0:
-        output_image[output_y_size - ref_image.shape[0]:output_y_size, :] = ref_image
-        output_image[0:y_difference, :] = moving_image[0:y_difference, :]
-        print("1")
-
-    elif abs(supposed_offset[0]) < abs(supposed_offset[1]) and supposed_offset[1] < 0:
-        print("2")
-        output_image[0:ref_image.shape[0], :] = ref_image
-        output_image[ref_image.shape[0]:output_y_size, :] = moving_image[0:y_difference, :]
+    # Stitching axis (0: vertical, 1: horizontal) and placement of both images along it: the image with the positive
+    # supposed offset is put after the other one
+    if abs(supposed_offset[1]) != abs(supposed_offset[0]):
+        axis = 0 if abs(supposed_offset[1]) > abs(supposed_offset[0]) else 1
+        difference = (y_difference, x_difference)[axis]
+        if supposed_offset[1 - axis] > 0:
+            ref_start, moving_start = difference, 0
+        else:
+            ref_start, moving_start = 0, ref_image.shape[axis]
 
-    elif abs(supposed_offset[0]) > abs(supposed_offset[1]) and supposed_offset[0] > 0:
-        print("3")
-        output_image[:, output_x_size - ref_image.shape[1]:output_x_size] = ref_image
-        output_image[:, 0:x_difference] = moving_image[:, 0:x_difference]
+        ref_window = [slice(None), slice(None)]
+        ref_window[axis] = slice(ref_start, ref_start + ref_image.shape[axis])
+        moving_window = [slice(None), slice(None)]
+        moving_window[axis] = slice(moving_start, moving_start + difference)
+        moving_crop = [slice(None), slice(None)]
+        moving_crop[axis] = slice(0, difference)
 
-    elif abs(supposed_offset[1]) < abs(supposed_offset[0]) and supposed_offset[0] < 0:
-        print("4")
-        output_image[:, 0:ref_image.shape[1]] = ref_image
-        output_image[:, ref_image.shape[1]:output_x_size] = moving_image[:, 0:x_difference]
+        output_image[tuple(ref_window)] = ref_image
+        output_image[tuple(moving_window)] = moving_image[tuple(moving_crop)]
 
     return output_image
 
@@ -440,21 +626,17 @@ def compute_two_tiles_registration(ref_image_input_folder, ref_image_coordinates
 
     """
     # We open the overlapping part of the ref image
-    ref_image = open_cropped_sequence(glob.glob(ref_image_input_folder + "\\*"), ref_image_coordinates)
+    ref_image = open_cropped_sequence(_list_images(ref_image_input_folder), ref_image_coordinates)
 
     # We compute the mask the registration will be based on (otsu threshold) -> faster registration
     threshold = filters.threshold_otsu(ref_image)
-    ref_mask = np.copy(ref_image)
-    ref_mask[ref_mask <= threshold] = 0
-    ref_mask[ref_mask > threshold] = 1
+    ref_mask = (ref_image > threshold).view(np.uint8)
 
     # We open the overlapping part of the moving image
-    moving_image = open_cropped_sequence(glob.glob(moving_image_input_folder + "\\*"), moving_image_coordinates)
-    moving_mask = np.copy(moving_image)
+    moving_image = open_cropped_sequence(_list_images(moving_image_input_folder), moving_image_coordinates)
 
     # We compute the mask the registration will be based on (Otsu threshold) -> faster registration
-    moving_mask[moving_mask <= threshold] = 0
-    moving_mask[moving_mask > threshold] = 1
+    moving_mask = (moving_image > threshold).view(np.uint8)
 
     # Registration computation (translation only)
     return registration_computation(moving_image=moving_image, ref_image=ref_image, ref_mask=ref_mask,
@@ -462,9 +644,160 @@ def compute_two_tiles_registration(ref_image_input_folder, ref_image_coordinates
                                     metric="msq", verbose=False)
 
 
+def _assemble_line_slices(slice_numbers, tile_files, z_offsets, ref_height, ref_width, supposed_overlap,
+                          output_folder):
+    """assembles and saves consecutive slices of a line of tiles (z offsets only, x/y offsets are not applied)
+
+    Each tile slice is interpolated between the two tile slices around its (z offset) position, then cropped (half of
+    the supposed overlap on its left side, except for the first tile, and on its right side) and placed after the
+    previous tile. The slices of each tile are kept
+    from one output slice to the next: only one new slice per tile is read
+
+    Args:
+        slice_numbers (list[int]):    consecutive output slice numbers
+        tile_files (list[list[str]]): slice file names of each tile of the line
+        z_offsets (list[float]):      z offset of each tile
+        ref_height (int):             tile height
+        ref_width (int):              tile width
+        supposed_overlap (int):       theoretical overlap between each tiles
+        output_folder (str):          output folder
+
+    Returns:
+        None
+    """
+    number_of_columns = len(tile_files)
+    # Source/destination columns of each tile: the first tile keeps its left part, the next ones are cropped on both
+    # sides and each one starts on the last column of the previous one
+    tile_windows = [(slice(0, ref_width - supposed_overlap // 2 + 1), slice(0, ref_width - supposed_overlap // 2 + 1))]
+    x_position = ref_width - supposed_overlap // 2
+    for _ in range(1, number_of_columns):
+        cropped_width = ref_width - supposed_overlap
+        tile_windows.append((slice(supposed_overlap - supposed_overlap // 2, ref_width - supposed_overlap // 2),
+                             slice(x_position, x_position + cropped_width)))
+        x_position += cropped_width - 1
+
+    # Slices of each tile before and after the current output slice, and their interpolation: one
+    # (number_of_columns, height, width) buffer each, the previous/next buffers are swapped from one slice to the next
+    previous_tiles = np.empty((number_of_columns, ref_height, ref_width), dtype=np.float32)
+    next_tiles = np.empty_like(previous_tiles)
+    interpolated_tiles = np.empty_like(previous_tiles)
+    is_loaded = np.zeros(number_of_columns, dtype=bool)
+    for slice_nb in slice_numbers:
+        # Creating the output image
+        empty_slice = np.zeros((ref_height,
+                                ref_width * number_of_columns - (number_of_columns - 1) * supposed_overlap),
+                               dtype=np.float32)
+
+        # We add each tile on after the other
+        for nb_col in range(number_of_columns):
+            current_slice_nb = slice_nb - z_offsets[nb_col]
+            # Tiles are shifted along z: a tile doesn't cover the first/last output slices of the line
+            if 0 < current_slice_nb and int(current_slice_nb) < len(tile_files[nb_col]):
+                if not is_loaded[nb_col]:
+                    np.copyto(previous_tiles[nb_col],
+                              open_memory_mapped_image(tile_files[nb_col][int(current_slice_nb)]))
+                    is_loaded[nb_col] = True
+                # On the last tile slice, the next slice is clamped to it
+                next_slice_nb = min(int(current_slice_nb) + 1, len(tile_files[nb_col]) - 1)
+                np.copyto(next_tiles[nb_col], open_memory_mapped_image(tile_files[nb_col][next_slice_nb]))
+                current_slice = interpolate_two_images(previous_tiles[nb_col], next_tiles[nb_col],
+                                                       current_slice_nb % 1, out=interpolated_tiles[nb_col])
+                source_columns, destination_columns = tile_windows[nb_col]
+                empty_slice[:, destination_columns] = current_slice[:, source_columns]
+        previous_tiles, next_tiles = next_tiles, previous_tiles
+        save_tif_image(empty_slice, os.path.join(output_folder, '{:04d}'.format(slice_nb)))
+
+
+def _compute_line_z_offsets(line_transformations):
+    """computes the z offset of each tile of a line from the transformations between its neighboring tiles, z offsets
+    are then handled by slice interpolation: the z component of each transformation is set to 0
+
+    Args:
+        line_transformations (list[Sitk.TranslationTransform]): transformations between neighboring tiles of the line
+
+    Returns:
+        (list[float]): z offset of each tile (the lowest one is 0)
+    """
+    list_of_z_offset = [0]
+    for transformation in line_transformations:
+        transformation_offset = transformation.GetOffset()
+        list_of_z_offset.append(list_of_z_offset[-1] + transformation_offset[-1])
+        transformation.SetOffset((transformation_offset[0], transformation_offset[1], 0))
+    min_offset = min(list_of_z_offset)
+    return [offset - min_offset for offset in list_of_z_offset]
+
+
+def _assemble_line(tile_files, z_offsets, nb_of_slices, ref_height, ref_width, supposed_overlap, output_folder):
+    """assembles and saves every slice of a line of tiles, output slices are independent: contiguous chunks of slices
+    are assembled/saved by parallel processes
+
+    Args:
+        tile_files (list[list[str]]): slice file names of each tile of the line
+        z_offsets (list[float]):      z offset of each tile
+        nb_of_slices (int):           number of slices of a tile
+        ref_height (int):             tile height
+        ref_width (int):              tile width
+        supposed_overlap (int):       theoretical overlap between each tiles
+        output_folder (str):          output folder
+
+    Returns:
+        None
+    """
+    nb_of_line_slices = nb_of_slices + round(max(z_offsets))
+    nb_of_workers = max(1, min(os.cpu_count(), nb_of_line_slices))
+    # Created once, before the workers save their slices into it
+    create_directory(output_folder)
+    with _process_pool(nb_of_workers) as executor:
+        list(executor.map(_assemble_line_slices,
+                          [chunk.tolist() for chunk in np.array_split(np.arange(nb_of_line_slices), nb_of_workers)],
+                          repeat(tile_files), repeat(z_offsets), repeat(ref_height), repeat(ref_width),
+                          repeat(supposed_overlap), repeat(output_folder)))
+
+
+def _compute_lines_offset(ref_line_folder, moving_line_folder, supposed_overlap, integer_values_for_offset):
+    """computes the offset between two neighboring lines (overlap between the bottom of the first one and the top of
+    the second one)
+
+    Args:
+        ref_line_folder (str):            reference line folder
+        moving_line_folder (str):         moving line folder
+        supposed_overlap (int):           theoretical overlap between the two lines
+        integer_values_for_offset (bool): rounds the offset (no interpolation)
+
+    Returns:
+        (tuple[float]): translation offset
+    """
+    # This time, the registration is vertical, not horizontal. The overlapping parts correspond to the
+    # bottom/upper-end of each line
+    transformation = compute_two_tiles_registration(ref_line_folder, [[0, -1], [-supposed_overlap, -1], [0, -1]],
+                                                    moving_line_folder, [[0, -1], [0, supposed_overlap], [0, -1]])
+    # If we want to avoid interpolation -> integer offset
+    if integer_values_for_offset:
+        return tuple(float(round(value)) for value in transformation.GetOffset())
+    return tuple(transformation.GetOffset())
+
+
+def _register_line(line_folder, offset, output_folder, backend="sitk"):
+    """opens a line, translates it and saves the registered line
+
+    Args:
+        line_folder (str):    input line folder
+        offset (list[float]): translation offset
+        output_folder (str):  output folder
+        backend (str):        "sitk": SimpleITK, "numpy": scipy, "cuda": GPU (cupy)
+
+    Returns:
+        None
+    """
+    line = open_sequence(line_folder)
+    line = _translate_image(line, offset, backend)
+    save_tif_sequence(line, os.path.join(output_folder, ""))
+
+
 def multiple_tile_registration(input_folder, radix, starting_position="top-left", number_of_lines=4,
                                number_of_columns=3,
-                               supposed_overlap=120, integer_values_for_offset=False, verbose=False):
+                               supposed_overlap=120, integer_values_for_offset=False, verbose=False, backend="sitk",
+                               max_workers=2):
     """Stitches multiple 3D tiles altogether and saves the result in a "final image" folder
 
     Args:
@@ -475,23 +808,35 @@ def multiple_tile_registration(input_folder, radix, starting_position="top-left"
         number_of_columns (int):          Number of columns in the final grid
         supposed_overlap (int):           Theoretical overlap between each images
         integer_values_for_offset (bool): Integer values for registration ? (to avoid interpolation)
+        verbose (bool):                   True: prints progress and timings of each step
+        backend (str):                    line translations, "sitk": SimpleITK, "numpy": scipy, "cuda": GPU (cupy)
+        max_workers (int):                Maximum number of lines registered at once (each worker loads full lines)
 
     Returns (None):
 
     """
     if verbose:
-        full_time_start = time.clock()
-        time_start = time.clock()
+        full_time_start = time.perf_counter()
+        time_start = full_time_start
     # Sorts indices of input tiles so that every tile is registered from left to right & from top to bottom.
     folders_indices = rearrange_folders_list(starting_position, number_of_lines, number_of_columns)
 
     # Listing input folders
-    list_of_folders = glob.glob(input_folder + radix + "*")
-    reference_image_path = glob.glob(list_of_folders[0] + "\\" + "*")[0]
+    list_of_folders = glob.glob(os.path.join(input_folder, radix + "*"))
+    # Intermediate (combined/registered lines) and output folders
+    combined_line_folders = [os.path.join(input_folder, "combined_line_" + str(nb_line))
+                             for nb_line in range(number_of_lines)]
+    registered_line_folders = [os.path.join(input_folder, "registered_line_" + str(nb_line))
+                               for nb_line in range(number_of_lines - 1)]
+    final_image_folder = os.path.join(input_folder, "final_image")
+
+    # Every tile folder is listed once (the slice loops index these listings)
+    folder_files = [_list_images(folder) for folder in list_of_folders]
+    reference_image_path = folder_files[0][0]
 
     # Opening a reference image for reference height/width
     reference_image = open_image(reference_image_path)
-    nb_of_slices = len(glob.glob(list_of_folders[0] + "\\" + "*"))
+    nb_of_slices = len(folder_files[0])
     ref_height = reference_image.shape[0]
     ref_width = reference_image.shape[1]
 
@@ -507,25 +852,25 @@ def multiple_tile_registration(input_folder, radix, starting_position="top-left"
                                 [0, min(supposed_overlap, reference_image.shape[1] - 1)]]
     list_of_transformations = []
     if verbose:
-        print("1. Introduction time:", (time.clock() - time_start))
+        now = time.perf_counter()
+        print("1. Introduction time:", now - time_start)
+        time_start = now
 
-    time_start = time.clock()
     # 1. Registration computation, for each line of the final grid, we compute the offset between each neighboring tiles
     i = 0
     for nb_line in range(number_of_lines):
         for nb_col in range(number_of_columns - 1):  # We compute registration on number_of_columns-1 pairs of images
 
             image_number = nb_line * number_of_columns + nb_col  # We keep track of the ref_image number we're working on
-            print("stitching tile number", folders_indices[image_number],
-                  "and tile number", folders_indices[image_number + 1])
-
-            reg_start = time.clock()
+            if verbose:
+                print("stitching tile number", folders_indices[image_number],
+                      "and tile number", folders_indices[image_number + 1])
+                reg_start = time.perf_counter()
 
             # transformation = compute_two_tiles_registration(list_of_folders[folders_indices[image_number]],
             #                                                 ref_image_coordinates,
             #                                                 list_of_folders[folders_indices[image_number + 1]],
             #                                                 moving_image_coordinates)
-            import SimpleITK as Sitk
             transformation = Sitk.TranslationTransform(3)
             manual_transforms = [[0.126,-2.12,3.12],
                                 [0.126,2.12,3.12],
@@ -537,7 +882,8 @@ def multiple_tile_registration(input_folder, radix, starting_position="top-left"
                                 [0.126,-2.12,3.12]]
             transformation.SetOffset((manual_transforms[i][0],manual_transforms[i][1],manual_transforms[i][2]))
             i+=1
-            print("Registration time:", (time.clock() - reg_start))
+            if verbose:
+                print("Registration time:", (time.perf_counter() - reg_start))
             # If we want to avoid interpolation -> integer offset
             if integer_values_for_offset:
                 transformation.SetOffset((round(transformation.GetOffset()[0]),
@@ -546,120 +892,49 @@ def multiple_tile_registration(input_folder, radix, starting_position="top-left"
 
             list_of_transformations.append(transformation)
     if verbose:
-        print("2. First Registrations time:", (time.clock() - time_start))
-        time_start = time.clock()
+        now = time.perf_counter()
+        print("2. First Registrations time:", now - time_start)
+        time_start = now
 
     # 2. Concatenation of same line tiles, line are saved in combined_line_XX folders
     for nb_line in range(number_of_lines):
-        x_position = 0
-        list_of_z_offset = [0]
-        for transformation_nb in range(number_of_columns - 1):  # Each tile needs to be registered using previous registrations
-            print("transfo nb", transformation_nb)
-            transformation_offset = list_of_transformations[nb_line * (number_of_columns - 1)
-                                                             + transformation_nb].GetOffset()[-1].GetOffset()
-            list_of_z_offset.append(transformation_offset[-1])
-            list_of_transformations[nb_line * (number_of_columns - 1)
-                                    + transformation_nb].GetOffset()[-1].SetOffset((transformation_offset[0],
-                                                                                    transformation_offset[1],
-                                                                                    0  ))
-            list_of_z_offset[-1] = sum(list_of_z_offset)
-        min_offset = min(list_of_z_offset)
-        list_of_z_offset = [offset - min_offset for offset in list_of_z_offset]
-
-        print("list of z offset:", list_of_z_offset)
-        for slice_nb in range(nb_of_slices + round(max(list_of_z_offset))):
-            list_of_slices = [[None, None], [None, None], [None, None]]
-            # Creating the output image
-            empty_slice = np.zeros((ref_height,
-                                    ref_width * number_of_columns - (number_of_columns - 1) * supposed_overlap))
-
-            # We add each tile on after the other
-            for nb_col in range(number_of_columns):
-                image_number = nb_line * number_of_columns + nb_col
-                current_slice_nb = slice_nb - list_of_z_offset[nb_col]
-                if current_slice_nb > 0:
-                    if nb_col == 0:
-                        if list_of_slices[nb_col][1] is not None:
-                            list_of_slices[nb_col][1] = list_of_slices[nb_col][0]
-                        else:
-                            list_of_slices[nb_col][1] = open_cropped_image(glob.glob(list_of_folders[folders_indices[image_number]] + "\\*")[int(current_slice_nb)],
-                                                                           [[0, -1], [0, ref_width - supposed_overlap // 2]])
-                        list_of_slices[nb_col][0] = open_cropped_image(glob.glob(list_of_folders[folders_indices[image_number]] + "\\*")[int(current_slice_nb) + 1],
-                                                                       [[0, -1], [0, ref_width - supposed_overlap // 2]])
-                        current_slice = interpolate_two_images(list_of_slices[nb_col][1], list_of_slices[nb_col][0], current_slice_nb % 1)
-                        empty_slice[:, :, 0:ref_width - supposed_overlap // 2 + 1] = current_slice
-                        x_position = ref_width - supposed_overlap // 2
-                    else:
-                        if list_of_slices[nb_col][1] is not None:
-                            list_of_slices[nb_col][1] = list_of_slices[nb_col][0]
-                        else:
-                            list_of_slices[nb_col][1] = open_image(glob.glob(list_of_folders[folders_indices[image_number]] + "\\*")[int(current_slice_nb)])
-                        list_of_slices[nb_col][0] = open_image(glob.glob(list_of_folders[folders_indices[image_number]] + "\\*")[int(current_slice_nb) + 1])
-                        current_slice = interpolate_two_images(list_of_slices[nb_col][1], list_of_slices[nb_col][0], current_slice_nb % 1)
-                        x_position = ref_width - supposed_overlap // 2
-        # empty_image = np.zeros((nb_of_slices,
-        #                         ref_height,
-        #                         ref_width * number_of_columns - (number_of_columns - 1) * supposed_overlap))
-        # # We add each tile on after the other
-        # for nb_col in range(number_of_columns):
-        #     image_number = nb_line * number_of_columns + nb_col
-        #
-        #     # The first tile doesn't need any registration
-        #     if nb_col == 0:
-        #         empty_image[:, :, 0:ref_width - supposed_overlap // 2 + 1] = \
-        #             open_cropped_sequence(glob.glob(list_of_folders[folders_indices[image_number]] + "\\*"),
-        #                                   [[0, -1], [0, -1], [0, ref_width - supposed_overlap // 2]])
-        #         x_position = ref_width - supposed_overlap // 2
-        #
-        #     # The next tile need to be registered/cropped
-        #     else:
-        #         image_to_register = open_sequence(glob.glob(list_of_folders[folders_indices[image_number]] + "\\*"))
-        #         for transformation_nb in range(nb_col):  # Each tile needs to be registered using previous registrations
-        #             image_to_register = apply_itk_transformation(image_to_register,
-        #                                                          list_of_transformations[
-        #                                                              nb_line * (number_of_columns - 1)
-        #                                                              + transformation_nb])
-        #         # After registration comes the cropping part (based on initial supposed overlap)
-        #         image_to_register = \
-        #             image_to_register[:, :, supposed_overlap - supposed_overlap // 2:ref_width - supposed_overlap // 2]
-        #
-        #         # We add the current tile to the final image
-        #         empty_image[:, :, x_position: x_position + image_to_register.shape[2]] = image_to_register
-        #
-        #         # We update the "x_position" corresponding to the position the next tile needs to be positionned at
-        #         x_position += image_to_register.shape[2] - 1
-        #
-        # print("-> Saving line number", nb_line, "in folder", input_folder + "combined_line_" + str(nb_line) + "\\")
-        # save_tif_sequence(empty_image, input_folder + "combined_line_" + str(nb_line) + "\\")
-        # print("--> Line number", nb_line, "saved !")
-
-    # 3. Registration computation, we compute the offset between each neighboring lines
-    list_of_transformations = []
-    for nb_line in range(number_of_lines - 1):
-        # This time, the registration is vertical, not horizontal. The overlapping parts correspond to the
-        # bottom/upper-end of each line
-        transformation = compute_two_tiles_registration(input_folder + "combined_line_" + str(nb_line),
-                                                        [[0, -1], [-supposed_overlap, -1], [0, -1]],
-                                                        input_folder + "combined_line_" + str(nb_line + 1),
-                                                        [[0, -1], [0, supposed_overlap], [0, -1]])
-        # If we want to avoid interpolation -> integer offset
-        if integer_values_for_offset:
-            transformation.SetOffset((round(transformation.GetOffset()[0]),
-                                      round(transformation.GetOffset()[1]),
-                                      round(transformation.GetOffset()[2])))
-        list_of_transformations.append(transformation)
-
-    # 4. Registration of each line (Because of memory limitations)
-    for nb_line in range(number_of_lines - 1):
-        line = open_sequence(input_folder + "combined_line_" + str(nb_line + 1) + "\\")
-        for nb_transformation in range(nb_line + 1):
-            line = apply_itk_transformation(line, list_of_transformations[nb_transformation])
-        save_tif_sequence(line, input_folder + "registered_line_" + str(nb_line) + "\\")
-        print("Registered line number", nb_line, "saved !")
-
-    if verbose :
-        print("3. Second Registrations time:", (time.clock() - time_start))
-        time_start = time.clock()
+        # Each tile is positioned using previous registrations
+        list_of_z_offset = _compute_line_z_offsets(
+            list_of_transformations[nb_line * (number_of_columns - 1):(nb_line + 1) * (number_of_columns - 1)])
+        if verbose:
+            print("list of z offset:", list_of_z_offset)
+        _assemble_line([folder_files[folders_indices[nb_line * number_of_columns + nb_col]]
+                        for nb_col in range(number_of_columns)],
+                       list_of_z_offset, nb_of_slices, ref_height, ref_width, supposed_overlap,
+                       combined_line_folders[nb_line])
+
+    # 3. Registration computation, we compute the offset between each neighboring lines. Each registration only needs
+    # its two lines: they are computed in parallel processes (offsets are returned, Sitk transforms are not picklable)
+    list_of_offsets = []
+    if number_of_lines > 1:
+        with _process_pool(min(number_of_lines - 1, os.cpu_count(), max_workers)) as executor:
+            list_of_offsets = list(executor.map(_compute_lines_offset, combined_line_folders[:-1],
+                                                combined_line_folders[1:],
+                                                repeat(supposed_overlap), repeat(integer_values_for_offset)))
+
+    # 4. Registration of each line (Because of memory limitations, a line is loaded/registered/saved by one worker),
+    # the lines are independent once the transformations are known: they are registered in parallel processes (at most
+    # max_workers lines in memory at once)
+    # A line is registered with the composition of all previous transformations: translations compose into a single
+    # translation (sum of offsets), each line is resampled only once
+    list_of_composed_offsets = np.cumsum(list_of_offsets, axis=0).tolist()
+    if number_of_lines > 1:
+        with _process_pool(min(number_of_lines - 1, os.cpu_count(), max_workers)) as executor:
+            registered_lines = executor.map(_register_line, combined_line_folders[1:], list_of_composed_offsets,
+                                            registered_line_folders, repeat(backend))
+            for nb_line, _ in enumerate(registered_lines):
+                if verbose:
+                    print("Registered line number", nb_line, "saved !")
+
+    if verbose:
+        now = time.perf_counter()
+        print("3. Second Registrations time:", now - time_start)
+        time_start = now
     # 5. Concatenation of every lines of the final grid
     list_of_line_images = []
     list_of_len = []
@@ -667,33 +942,49 @@ def multiple_tile_registration(input_folder, radix, starting_position="top-left"
     # For this purpose, we need to list all input slices
     for nb_line in range(number_of_lines):
         if nb_line == 0:
-            list_of_line_images.append(create_list_of_files(input_folder + "combined_line_" + str(nb_line) + "\\",
-                                                            "tif"))
+            list_of_line_images.append(create_list_of_files(combined_line_folders[nb_line], "tif"))
         else:
-            list_of_line_images.append(create_list_of_files(input_folder + "registered_line_" + str(nb_line - 1) + "\\",
-                                                            "tif"))
+            list_of_line_images.append(create_list_of_files(registered_line_folders[nb_line - 1], "tif"))
         list_of_len.append(len(list_of_line_images[-1]))
 
-    # We concatenate lines one slice at a time
-    empty_image = np.zeros((number_of_lines * ref_height - supposed_overlap * (number_of_lines - 1),
-                            ref_width * number_of_columns - supposed_overlap * (number_of_columns - 1)))
-    # Concatenation
-    for nb_image in range(min(list_of_len)):
-        for nb_line in range(number_of_lines):
-            out_slice = open_image(list_of_line_images[nb_line][nb_image])
-            if nb_line == 0:
-                empty_image[0: out_slice.shape[0] - supposed_overlap // 2, :] = \
-                    out_slice[0:out_slice.shape[0] - supposed_overlap // 2, :]
-            else:
-                empty_image[nb_line * (ref_height - supposed_overlap // 2) - (nb_line - 1) * supposed_overlap // 2:
-                            nb_line * ref_height - (2 * nb_line + 1) * supposed_overlap // 2 + out_slice.shape[0], :] \
-                    = out_slice[supposed_overlap // 2:out_slice.shape[0] - supposed_overlap // 2, :]
-        save_tif_image(empty_image, input_folder + "final_image\\" + '{:04d}'.format(nb_image))
+    # We concatenate lines one slice at a time (float32, the type the final slices are saved in). Two output buffers
+    # are alternated: one is assembled while the previous one is being saved
+    output_slices = [np.zeros((number_of_lines * ref_height - supposed_overlap * (number_of_lines - 1),
+                               ref_width * number_of_columns - supposed_overlap * (number_of_columns - 1)),
+                              dtype=np.float32) for _ in range(2)]
+    # Destination/source rows of each line (line slices are ref_height high), computed once for all output slices
+    half_overlap = supposed_overlap // 2
+    line_windows = [(slice(0, ref_height - half_overlap), slice(0, ref_height - half_overlap))]
+    for nb_line in range(1, number_of_lines):
+        line_start = nb_line * (ref_height - half_overlap) - (nb_line - 1) * half_overlap
+        line_stop = nb_line * ref_height - (2 * nb_line + 1) * half_overlap + ref_height
+        line_windows.append((slice(line_start, line_stop), slice(half_overlap, ref_height - half_overlap)))
+
+    # Concatenation, the line slices of the next output slice are read ahead while the current one is assembled/saved
+    filenames_per_output_slice = [[list_of_line_images[nb_line][nb_image] for nb_line in range(number_of_lines)]
+                                  for nb_image in range(min(list_of_len))]
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending_write = None
+        for nb_image, line_slices in enumerate(_read_ahead(filenames_per_output_slice)):
+            # The windows above assume ref_height high line slices, checked once on the first output slice
+            if nb_image == 0 and any(out_slice.shape[0] != ref_height for out_slice in line_slices):
+                raise Exception('Error: line slices are expected to be ' + str(ref_height) + ' pixels high')
+            # This buffer's previous write was waited for before submitting the previous slice
+            empty_image = output_slices[nb_image % 2]
+            for (destination_rows, source_rows), out_slice in zip(line_windows, line_slices):
+                np.copyto(empty_image[destination_rows, :], out_slice[source_rows, :])
+            if pending_write is not None:
+                pending_write.result()
+            pending_write = writer.submit(save_tif_image, empty_image,
+                                          os.path.join(final_image_folder, '{:04d}'.format(nb_image)))
+        if pending_write is not None:
+            pending_write.result()
     print("Stitching done.")
 
     if verbose:
-        print("4. Second Concatenation time:", (time.clock() - time_start))
-        print("Total:", (time.clock() - full_time_start))
+        now = time.perf_counter()
+        print("4. Second Concatenation time:", now - time_start)
+        print("Total:", now - full_time_start)
 
 
 if __name__ == "__main__":
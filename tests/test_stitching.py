@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from popcorn.input_output import create_list_of_files, open_image, save_tif_sequence
+from popcorn.stitching import look_for_maximum_correlation_band, multiple_tile_registration
+
+
+class MultipleTileRegistrationTest(unittest.TestCase):
+    """end-to-end stitching of a small synthetic grid of 3D tiles"""
+
+    nb_of_slices = 12
+    tile_size = 40
+    supposed_overlap = 10
+
+    def setUp(self):
+        self.input_folder = tempfile.mkdtemp()
+        volume = np.random.default_rng(0).random((self.nb_of_slices, 80, 80)).astype(np.float32) + 1
+        step = self.tile_size - self.supposed_overlap
+        tile_nb = 0
+        for y in (0, step):
+            for x in (0, step):
+                save_tif_sequence(volume[:, y:y + self.tile_size, x:x + self.tile_size],
+                                  os.path.join(self.input_folder, "tile_" + str(tile_nb), ""))
+                tile_nb += 1
+
+    def tearDown(self):
+        shutil.rmtree(self.input_folder)
+
+    def test_every_line_slice_is_assembled(self):
+        multiple_tile_registration(self.input_folder, "tile_", number_of_lines=2, number_of_columns=2,
+                                   supposed_overlap=self.supposed_overlap, integer_values_for_offset=True)
+
+        line_slices = create_list_of_files(os.path.join(self.input_folder, "combined_line_0"), "tif")
+        # The first registrations shift the second tile of the line by 3 slices along z
+        self.assertEqual(len(line_slices), self.nb_of_slices + 3)
+        # Both tiles cover the middle slices: every tile column is placed (the input volume has no zero)
+        line_slice = open_image(line_slices[self.nb_of_slices // 2])
+        placed_width = 2 * self.tile_size - self.supposed_overlap - self.supposed_overlap // 2
+        self.assertTrue(np.all(line_slice[:, :placed_width] > 0))
+        final_slices = create_list_of_files(os.path.join(self.input_folder, "final_image"), "tif")
+        self.assertEqual(open_image(final_slices[0]).shape,
+                         (2 * self.tile_size - self.supposed_overlap, 2 * self.tile_size - self.supposed_overlap))
+
+
+class LookForMaximumCorrelationBandTest(unittest.TestCase):
+    """slice matching between two overlapping volumes"""
+
+    def setUp(self):
+        self.image = np.random.default_rng(0).random((8, 20, 20)).astype(np.float32)
+
+    def test_identical_images_match_on_middle_slice(self):
+        for with_segmentation in (True, False):
+            self.assertEqual(look_for_maximum_correlation_band(self.image, self.image.copy(), 4, with_segmentation),
+                             self.image.shape[0] // 2)
+
+    def test_band_larger_than_image_raises(self):
+        for with_segmentation in (True, False):
+            with self.assertRaises(Exception):
+                look_for_maximum_correlation_band(self.image, self.image.copy(), 10, with_segmentation)
+
+
+if __name__ == "__main__":
+    unittest.main()